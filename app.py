@@ -1,16 +1,28 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import random
 import datetime
 import calendar
+import functools
 import io
+import base64
 import os
 import logging
 import re
 import smtplib
+import atexit
+import weakref
+import socket
+import ssl
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
+from email import policy as email_policy
 from faker import Faker
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
@@ -19,10 +31,19 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib import colors
 from reportlab.lib.units import inch
 from reportlab.lib.enums import TA_LEFT, TA_RIGHT
-from PIL import Image as PILImage, ImageDraw, ImageFont
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from PIL import Image as PILImage
 
-# Initialize Faker outside of any Streamlit blocks so it's globally available
-faker = Faker()
+# Building a Faker loads its locale providers, so one instance is shared per process
+@st.cache_resource
+def _get_faker():
+    return Faker()
+
+@st.cache_resource
+def _get_name_pool(size=512):
+    """Names for {NAME_PLACEHOLDER}: drawn from Faker once, then sampled with random.choice."""
+    faker = _get_faker()
+    return tuple(faker.name() for _ in range(size))
 
 # --- Constants for Invoice Generator ---
 EXPENSE_CODES = {
@@ -74,29 +95,55 @@ MAJOR_TASK_CODES = {"L110", "L120", "L130", "L140", "L150", "L160", "L170", "L18
 DEFAULT_CLIENT_ID = "02-4388252"
 DEFAULT_LAW_FIRM_ID = "02-1234567"
 DEFAULT_INVOICE_DESCRIPTION = "Monthly Legal Services"
+_DATE_RE = re.compile(r"\b(\d{2}/\d{2}/\d{4})\b")
+_HAS_MARKUP = re.compile(r"[<&]").search
+# Bound formatters parse their format spec once instead of on every f-string evaluation
+_fmt_1dp = "{:.1f}".format
+_fmt_2dp = "{:.2f}".format
+_fmt_dollars = "${:.2f}".format
 
 # --- Functions from Original Script, adapted for Streamlit ---
-def _replace_name_placeholder(description, faker_instance):
-    return description.replace("{NAME_PLACEHOLDER}", faker_instance.name())
+def _replace_name_placeholder(description, name_pool):
+    if "{NAME_PLACEHOLDER}" not in description:
+        return description
+    return description.replace("{NAME_PLACEHOLDER}", random.choice(name_pool))
+
+def _replace_description_dates(description, recent_dates):
+    # One scan: the replacement date is only drawn when a date is actually found
+    return _DATE_RE.sub(lambda _: random.choice(recent_dates), description, count=1)
 
-def _replace_description_dates(description):
-    pattern = r"\b(\d{2}/\d{2}/\d{4})\b"
-    if re.search(pattern, description):
-        days_ago = random.randint(15, 90)
-        new_date = (datetime.date.today() - datetime.timedelta(days=days_ago)).strftime("%m/%d/%Y")
-        return re.sub(pattern, new_date, description)
-    return description
+@functools.lru_cache(maxsize=2)
+def _recent_description_dates(today):
+    """Every date a description can be rewritten to: 15 to 90 days before today."""
+    return tuple((today - datetime.timedelta(days=days_ago)).strftime("%m/%d/%Y") for days_ago in range(15, 91))
 
+# Uploads are parsed from their bytes so st.cache_data can key on the content; widget
+# interactions rerun the script, and an unchanged file shouldn't be parsed again
 def _load_timekeepers(uploaded_file):
     if uploaded_file is None:
         return None
+    return _parse_timekeepers_csv(uploaded_file.getvalue())
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _parse_timekeepers_csv(file_bytes):
     try:
-        df = pd.read_csv(uploaded_file)
         required_cols = ["TIMEKEEPER_NAME", "TIMEKEEPER_CLASSIFICATION", "TIMEKEEPER_ID", "RATE"]
+        # Only parse the columns we use, with declared types so pandas skips type inference
+        df = pd.read_csv(
+            io.BytesIO(file_bytes),
+            usecols=lambda col: col in required_cols,
+            dtype={"TIMEKEEPER_NAME": str, "TIMEKEEPER_CLASSIFICATION": str, "TIMEKEEPER_ID": str, "RATE": "float64"},
+            engine="c",
+        )
         if not all(col in df.columns for col in required_cols):
             st.error(f"Timekeeper CSV must contain the following columns: {', '.join(required_cols)}")
             return None
-        return df.to_dict(orient='records')
+        # Line totals are computed in integer cents, so every timekeeper needs a real rate
+        if not np.isfinite(df["RATE"]).all():
+            st.error("Timekeeper CSV has a missing or invalid RATE value; every timekeeper needs a numeric rate.")
+            return None
+        # Parallel arrays (one per column) so invoice generation can fancy-index them by timekeeper
+        return {col: df[col].to_numpy() for col in required_cols}
     except Exception as e:
         st.error(f"Error loading timekeeper file: {e}")
         return None
@@ -104,63 +151,32 @@ def _load_timekeepers(uploaded_file):
 def _load_custom_task_activity_data(uploaded_file):
     if uploaded_file is None:
         return None
+    return _parse_custom_task_activity_csv(uploaded_file.getvalue())
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _parse_custom_task_activity_csv(file_bytes):
     try:
-        df = pd.read_csv(uploaded_file)
         required_cols = ["TASK_CODE", "ACTIVITY_CODE", "DESCRIPTION"]
+        # Read everything as text (blank cells stay "") so rows can be handed out as-is
+        df = pd.read_csv(
+            io.BytesIO(file_bytes),
+            usecols=lambda col: col in required_cols,
+            dtype=str,
+            keep_default_na=False,
+            engine="c",
+        )
         if not all(col in df.columns for col in required_cols):
             st.error(f"Custom Task/Activity CSV must contain the following columns: {', '.join(required_cols)}")
             return None
         if df.empty:
             st.warning("Custom Task/Activity CSV file is empty.")
             return []
-        custom_tasks = []
-        for _, row in df.iterrows():
-            custom_tasks.append((str(row["TASK_CODE"]), str(row["ACTIVITY_CODE"]), str(row["DESCRIPTION"])))
-        return custom_tasks
+        return list(df[required_cols].itertuples(index=False, name=None))
     except Exception as e:
         st.error(f"Error loading custom tasks file: {e}")
         return None
-def _create_ledes_line_1998b(row, line_no, inv_total, bill_start, bill_end, invoice_number, matter_number):
-    date_obj = datetime.datetime.strptime(row["LINE_ITEM_DATE"], "%Y-%m-%d").date()
-    hours = float(row["HOURS"])
-    rate = float(row["RATE"])
-    line_total = float(row["LINE_ITEM_TOTAL"])
-    is_expense = bool(row["EXPENSE_CODE"])
-    adj_type = "E" if is_expense else "F"
-    task_code = "" if is_expense else row.get("TASK_CODE", "")
-    activity_code = "" if is_expense else row.get("ACTIVITY_CODE", "")
-    expense_code = row.get("EXPENSE_CODE", "") if is_expense else ""
-    timekeeper_id = "" if is_expense else row.get("TIMEKEEPER_ID", "")
-    timekeeper_class = "" if is_expense else row.get("TIMEKEEPER_CLASSIFICATION", "")
-    timekeeper_name = "" if is_expense else row.get("TIMEKEEPER_NAME", "")
-    return [
-        bill_end.strftime("%Y%m%d"),
-        invoice_number,
-        str(row.get("CLIENT_ID", "")),
-        matter_number,
-        f"{inv_total:.2f}",
-        bill_start.strftime("%Y%m%d"),
-        bill_end.strftime("%Y%m%d"),
-        str(row.get("INVOICE_DESCRIPTION", "")),
-        str(line_no),
-        adj_type,
-        f"{hours:.1f}" if adj_type == "F" else f"{int(hours)}",
-        "0.00",
-        f"{line_total:.2f}",
-        date_obj.strftime("%Y%m%d"),
-        task_code,
-        expense_code,
-        activity_code,
-        timekeeper_id,
-        str(row.get("DESCRIPTION", "")),
-        str(row.get("LAW_FIRM_ID", "")),
-        f"{rate:.2f}",
-        timekeeper_name,
-        timekeeper_class,
-        matter_number
-    ]
 
-def _create_ledes_1998b_content(rows, inv_total, bill_start, bill_end, invoice_number, matter_number):
+def _create_ledes_1998b_content(df, inv_total, bill_start, bill_end, invoice_number, matter_number):
     header = "LEDES1998B[]"
     fields = ("INVOICE_DATE|INVOICE_NUMBER|CLIENT_ID|LAW_FIRM_MATTER_ID|INVOICE_TOTAL|BILLING_START_DATE|"
               "BILLING_END_DATE|INVOICE_DESCRIPTION|LINE_ITEM_NUMBER|EXP/FEE/INV_ADJ_TYPE|"
@@ -168,161 +184,307 @@ def _create_ledes_1998b_content(rows, inv_total, bill_start, bill_end, invoice_n
               "LINE_ITEM_TASK_CODE|LINE_ITEM_EXPENSE_CODE|LINE_ITEM_ACTIVITY_CODE|TIMEKEEPER_ID|"
               "LINE_ITEM_DESCRIPTION|LAW_FIRM_ID|LINE_ITEM_UNIT_COST|TIMEKEEPER_NAME|"
               "TIMEKEEPER_CLASSIFICATION|CLIENT_MATTER_ID[]")
-    lines = [header, fields]
-    for i, r in enumerate(rows, start=1):
-        line = _create_ledes_line_1998b(r, i, inv_total, bill_start, bill_end, invoice_number, matter_number)
-        lines.append("|".join(map(str, line)) + "[]")
-    return "\n".join(lines)
+    first = df.iloc[0] if len(df) else {}
+    bs = bill_start.strftime("%Y%m%d")
+    be = bill_end.strftime("%Y%m%d")
+    law_firm_id = str(first.get("LAW_FIRM_ID", ""))
+    # Invoice-level fields are identical on every line, so they are joined once into a prefix/suffix
+    prefix = "|".join([
+        be, invoice_number, str(first.get("CLIENT_ID", "")), matter_number, _fmt_2dp(inv_total),
+        bs, be, str(first.get("INVOICE_DESCRIPTION", "")).replace("|", ";"),
+    ]) + "|"
+    suffix = f"|{matter_number}[]"
 
-def _generate_invoice_data(fee_count, expense_count, timekeeper_data, client_id, law_firm_id, invoice_desc, billing_start_date, billing_end_date, task_activity_desc, major_task_codes, max_hours_per_tk_per_day, include_block_billed, faker_instance):
-    # This is a port of the original function.
-    # It generates a list of dictionaries for a single conceptual invoice.
-    rows = []
-    delta = billing_end_date - billing_start_date
-    num_days = delta.days + 1
+    # Format every column once as a string Series, then join them row-wise in a single pass
+    is_fee = df["EXPENSE_CODE"] == ""
+
+    def const(value):
+        return pd.Series(value, index=df.index, dtype=object)
+
+    def fee_only(col):
+        return df[col].astype(str).where(is_fee, "")
+
+    columns = [
+        pd.Series(range(1, len(df) + 1), index=df.index).astype(str),
+        const("F").where(is_fee, "E"),
+        df["HOURS"].map(_fmt_1dp).where(is_fee, df["HOURS"].astype(int).astype(str)),
+        const("0.00"),
+        df["LINE_ITEM_TOTAL"].map(_fmt_2dp),
+        df["LINE_ITEM_DATE_YMD"],
+        fee_only("TASK_CODE"),
+        df["EXPENSE_CODE"],
+        fee_only("ACTIVITY_CODE"),
+        fee_only("TIMEKEEPER_ID"),
+        # Descriptions are free text (custom CSVs included), so a stray '|' must not split the field
+        df["DESCRIPTION"].astype(str).str.replace("|", ";", regex=False),
+        const(law_firm_id),
+        df["RATE"].map(_fmt_2dp),
+        fee_only("TIMEKEEPER_NAME"),
+        fee_only("TIMEKEEPER_CLASSIFICATION"),
+    ]
+    body = prefix + columns[0].str.cat(others=columns[1:], sep="|") + suffix
+    # Encode once here so callers can attach/download the bytes without another copy
+    return "\n".join([header, fields, *body]).encode("utf-8")
+
+@functools.lru_cache(maxsize=16)
+def _period_date_tables(billing_start_date, billing_end_date):
+    """
+    Every line date falls in the billing period, so each day is formatted once (as
+    YYYY-MM-DD and YYYYMMDD) and looked up by day offset. Cached so invoices that share
+    a billing period also share the tables; lru_cache hands back the same arrays without
+    the copy st.cache_data makes, so they are marked read-only.
+    """
+    num_days = (billing_end_date - billing_start_date).days + 1
+    period_days = [billing_start_date + datetime.timedelta(days=d) for d in range(num_days)]
+    date_strs = np.array([d.strftime("%Y-%m-%d") for d in period_days], dtype=object)
+    date_ymds = np.array([d.strftime("%Y%m%d") for d in period_days], dtype=object)
+    date_strs.flags.writeable = False
+    date_ymds.flags.writeable = False
+    return date_strs, date_ymds
+
+def _split_task_activity_items(task_activity_desc, major_task_codes, include_block_billed):
+    """
+    Splits the task/activity templates into (major_items, other_items). Done once per
+    generate run, since the split is the same for every invoice in the batch.
+    """
+    if not include_block_billed:
+        # Drop block-billed templates up front rather than generating rows only to discard them
+        task_activity_desc = [item for item in task_activity_desc if "; " not in item[2]]
     major_items = [item for item in task_activity_desc if item[0] in major_task_codes]
     other_items = [item for item in task_activity_desc if item[0] not in major_task_codes]
-    current_invoice_total = 0.0
-    daily_hours_tracker = {}
+    return major_items, other_items
+
+def _generate_invoice_data(fee_count, expense_count, timekeeper_data, client_id, law_firm_id, invoice_desc, billing_start_date, billing_end_date, major_items, other_items, max_hours_per_tk_per_day, include_block_billed):
+    # This is a port of the original function.
+    # It generates a DataFrame of line items for a single conceptual invoice.
+    fees = pd.DataFrame()
+    # Expense lines are collected column-wise; the per-invoice constants are broadcast at the end
+    expense_cols = {"LINE_ITEM_DATE": [], "LINE_ITEM_DATE_YMD": [], "EXPENSE_CODE": [],
+                    "DESCRIPTION": [], "HOURS": [], "RATE": [], "LINE_ITEM_TOTAL": []}
+    date_strs, date_ymds = _period_date_tables(billing_start_date, billing_end_date)
+    num_days = len(date_strs)
+    # Money is tracked in integer cents and fee hours in integer tenths, so totals are exact sums
+    invoice_total_cents = 0
     MAX_DAILY_HOURS = max_hours_per_tk_per_day
+    rng = np.random.default_rng()
 
-    # Fee records
-    for _ in range(fee_count):
-        if not task_activity_desc: break
-        tk_row = random.choice(timekeeper_data)
-        timekeeper_id = tk_row["TIMEKEEPER_ID"]
-        if major_items and random.random() < 0.7:
-            task_code, activity_code, description = random.choice(major_items)
-        elif other_items:
-            task_code, activity_code, description = random.choice(other_items)
-        else: continue
-        random_day_offset = random.randint(0, num_days - 1)
-        line_item_date = billing_start_date + datetime.timedelta(days=random_day_offset)
-        line_item_date_str = line_item_date.strftime("%Y-%m-%d")
-        current_billed_hours = daily_hours_tracker.get((line_item_date_str, timekeeper_id), 0)
-        remaining_hours_capacity = MAX_DAILY_HOURS - current_billed_hours
-        if remaining_hours_capacity <= 0: continue
-        hours_to_bill = round(random.uniform(0.5, min(8.0, remaining_hours_capacity)), 1)
-        if hours_to_bill == 0: continue
-        hourly_rate = tk_row["RATE"]
-        line_item_total = round(hours_to_bill * hourly_rate, 2)
-        current_invoice_total += line_item_total
-        daily_hours_tracker[(line_item_date_str, timekeeper_id)] = current_billed_hours + hours_to_bill
-        description = _replace_description_dates(description)
-        description = _replace_name_placeholder(description, faker_instance)
-        row = {
+    # Fee records: sample the whole batch up front, then apply the daily cap per (date, timekeeper)
+    if (major_items or other_items) and fee_count > 0:
+        tk_idx = rng.integers(0, len(timekeeper_data["TIMEKEEPER_ID"]), size=fee_count)
+        day_offsets = rng.integers(0, num_days, size=fee_count)
+        major_idx = rng.integers(0, len(major_items) or 1, size=fee_count)
+        other_idx = rng.integers(0, len(other_items) or 1, size=fee_count)
+        if major_items:
+            use_major = rng.random(fee_count) < 0.7
+        else:
+            use_major = np.zeros(fee_count, dtype=bool)
+        # Without any "other" items, the rows that would have drawn one are dropped
+        keep = use_major | bool(other_items)
+        tk_idx, day_offsets, major_idx, other_idx, use_major = (
+            a[keep] for a in (tk_idx, day_offsets, major_idx, other_idx, use_major)
+        )
+        # An empty side is padded with one blank item; the mask above guarantees it is never selected
+        major_arr = np.array(major_items or [("", "", "")], dtype=object)
+        other_arr = np.array(other_items or [("", "", "")], dtype=object)
+        picked = np.where(use_major[:, None], major_arr[major_idx], other_arr[other_idx])
+        fees = pd.DataFrame({
             "INVOICE_DESCRIPTION": invoice_desc, "CLIENT_ID": client_id, "LAW_FIRM_ID": law_firm_id,
-            "LINE_ITEM_DATE": line_item_date_str, "TIMEKEEPER_NAME": tk_row["TIMEKEEPER_NAME"],
-            "TIMEKEEPER_CLASSIFICATION": tk_row["TIMEKEEPER_CLASSIFICATION"],
-            "TIMEKEEPER_ID": timekeeper_id, "TASK_CODE": task_code,
-            "ACTIVITY_CODE": activity_code, "EXPENSE_CODE": "", "DESCRIPTION": description,
-            "HOURS": hours_to_bill, "RATE": hourly_rate, "LINE_ITEM_TOTAL": line_item_total
-        }
-        rows.append(row)
+            "LINE_ITEM_DATE": date_strs[day_offsets],
+            "LINE_ITEM_DATE_YMD": date_ymds[day_offsets],
+            "TIMEKEEPER_NAME": timekeeper_data["TIMEKEEPER_NAME"][tk_idx],
+            "TIMEKEEPER_CLASSIFICATION": timekeeper_data["TIMEKEEPER_CLASSIFICATION"][tk_idx],
+            "TIMEKEEPER_ID": timekeeper_data["TIMEKEEPER_ID"][tk_idx],
+            "TASK_CODE": picked[:, 0], "ACTIVITY_CODE": picked[:, 1],
+            "EXPENSE_CODE": "", "DESCRIPTION": picked[:, 2],
+            "RATE": timekeeper_data["RATE"][tk_idx],
+        })
+        raw_tenths = pd.Series(rng.integers(5, 81, size=len(picked)))  # 0.5 to 8.0 hours
+        # Clipping the running total at the cap bills each row only what is left for that day
+        cap_tenths = int(round(MAX_DAILY_HOURS * 10))
+        # Group on one integer per (day, timekeeper ID) cell rather than hashing string pairs
+        tk_codes, tk_uniques = pd.factorize(timekeeper_data["TIMEKEEPER_ID"], use_na_sentinel=False)
+        cells = day_offsets * len(tk_uniques) + tk_codes[tk_idx]
+        cum_tenths = raw_tenths.groupby(cells).cumsum()
+        hours_tenths = cum_tenths.clip(upper=cap_tenths) - (cum_tenths - raw_tenths).clip(upper=cap_tenths)
+        rate_cents = (fees["RATE"] * 100).round().astype(np.int64)
+        line_cents = (hours_tenths * rate_cents + 5) // 10  # round half up to the cent
+        fees["HOURS"] = hours_tenths / 10
+        fees["LINE_ITEM_TOTAL"] = line_cents / 100
+        billed = hours_tenths > 0
+        fees = fees[billed].copy()
+        invoice_total_cents += int(line_cents[billed].sum())
+        # Rows repeat a few templates, so decide once per template which ones need rewriting
+        descriptions = fees["DESCRIPTION"]
+        templates_to_rewrite = [
+            desc for desc in descriptions.unique()
+            if "{NAME_PLACEHOLDER}" in desc or _DATE_RE.search(desc)
+        ]
+        rewrite = descriptions.isin(templates_to_rewrite)
+        if rewrite.any():
+            name_pool = _get_name_pool()
+            recent_dates = _recent_description_dates(datetime.date.today())
+            fees.loc[rewrite, "DESCRIPTION"] = [
+                _replace_name_placeholder(_replace_description_dates(desc, recent_dates), name_pool)
+                for desc in descriptions[rewrite]
+            ]
 
     # Expense records (E101 and others)
-    e101_actual_count = random.randint(1, min(3, expense_count))
-    for _ in range(e101_actual_count):
-        description = "Copying"
-        expense_code = "E101"
-        hours = random.randint(1, 200)
-        rate = round(random.uniform(0.14, 0.25), 2)
-        random_day_offset = random.randint(0, num_days - 1)
-        line_item_date = billing_start_date + datetime.timedelta(days=random_day_offset)
-        line_item_total = round(hours * rate, 2)
-        current_invoice_total += line_item_total
-        row = {
-            "INVOICE_DESCRIPTION": invoice_desc, "CLIENT_ID": client_id, "LAW_FIRM_ID": law_firm_id,
-            "LINE_ITEM_DATE": line_item_date.strftime("%Y-%m-%d"), "TIMEKEEPER_NAME": "",
-            "TIMEKEEPER_CLASSIFICATION": "", "TIMEKEEPER_ID": "", "TASK_CODE": "",
-            "ACTIVITY_CODE": "", "EXPENSE_CODE": expense_code, "DESCRIPTION": description,
-            "HOURS": hours, "RATE": rate, "LINE_ITEM_TOTAL": line_item_total
-        }
-        rows.append(row)
+    e101_actual_count = random.randint(1, min(3, expense_count)) if expense_count > 0 else 0
+
+    def add_expenses(day_offsets, expense_codes, descriptions, units, rate_cents):
+        # Each argument holds one entry per line; units and rate_cents are integer arrays
+        line_cents = units * rate_cents
+        expense_cols["LINE_ITEM_DATE"].extend(date_strs[day_offsets])
+        expense_cols["LINE_ITEM_DATE_YMD"].extend(date_ymds[day_offsets])
+        expense_cols["EXPENSE_CODE"].extend(expense_codes)
+        expense_cols["DESCRIPTION"].extend(descriptions)
+        expense_cols["HOURS"].extend(units.tolist())
+        expense_cols["RATE"].extend((rate_cents / 100).tolist())
+        expense_cols["LINE_ITEM_TOTAL"].extend((line_cents / 100).tolist())
+        return int(line_cents.sum())
+
+    # Copying lines: pages, day and per-page rate are each sampled for the whole batch at once
+    invoice_total_cents += add_expenses(
+        rng.integers(0, num_days, size=e101_actual_count),
+        ["E101"] * e101_actual_count, ["Copying"] * e101_actual_count,
+        rng.integers(1, 201, size=e101_actual_count), rng.integers(14, 26, size=e101_actual_count),
+    )
 
     remaining_expense_count = expense_count - e101_actual_count
-    if remaining_expense_count > 0:
-        if not OTHER_EXPENSE_DESCRIPTIONS:
-            pass
-        else:
-            for _ in range(remaining_expense_count):
-                description = random.choice(OTHER_EXPENSE_DESCRIPTIONS)
-                expense_code = EXPENSE_CODES[description]
-                hours = 1
-                rate = round(random.uniform(25, 200), 2)
-                random_day_offset = random.randint(0, num_days - 1)
-                line_item_date = billing_start_date + datetime.timedelta(days=random_day_offset)
-                line_item_total = round(hours * rate, 2)
-                current_invoice_total += line_item_total
-                row = {
-                    "INVOICE_DESCRIPTION": invoice_desc, "CLIENT_ID": client_id,
-                    "LAW_FIRM_ID": law_firm_id, "LINE_ITEM_DATE": line_item_date.strftime("%Y-%m-%d"),
-                    "TIMEKEEPER_NAME": "", "TIMEKEEPER_CLASSIFICATION": "",
-                    "TIMEKEEPER_ID": "", "TASK_CODE": "", "ACTIVITY_CODE": "",
-                    "EXPENSE_CODE": expense_code, "DESCRIPTION": description,
-                    "HOURS": hours, "RATE": rate, "LINE_ITEM_TOTAL": line_item_total
-                }
-                rows.append(row)
-
-    # Block Billing
-    if not include_block_billed:
-        rows = [row for row in rows if not ("; " in row["DESCRIPTION"])]
-    elif include_block_billed:
-        if not any('; ' in row['DESCRIPTION'] for row in rows):
-            for _, _, desc in task_activity_desc:
-                if '; ' in desc and len(rows) > 0:
-                    extra = rows[0].copy()
-                    extra['DESCRIPTION'] = desc
-                    rows.insert(0, extra)
-                    break
-    return rows, current_invoice_total
+    if remaining_expense_count > 0 and OTHER_EXPENSE_DESCRIPTIONS:
+        picks = rng.integers(0, len(OTHER_EXPENSE_DESCRIPTIONS), size=remaining_expense_count)
+        other_descriptions = [OTHER_EXPENSE_DESCRIPTIONS[j] for j in picks]
+        invoice_total_cents += add_expenses(
+            rng.integers(0, num_days, size=remaining_expense_count),
+            [EXPENSE_CODES[desc] for desc in other_descriptions], other_descriptions,
+            np.ones(remaining_expense_count, dtype=np.int64), rng.integers(2500, 20001, size=remaining_expense_count),
+        )
+
+    expenses = pd.DataFrame({
+        "INVOICE_DESCRIPTION": invoice_desc, "CLIENT_ID": client_id, "LAW_FIRM_ID": law_firm_id,
+        "LINE_ITEM_DATE": expense_cols["LINE_ITEM_DATE"],
+        "LINE_ITEM_DATE_YMD": expense_cols["LINE_ITEM_DATE_YMD"],
+        "TIMEKEEPER_NAME": "", "TIMEKEEPER_CLASSIFICATION": "", "TIMEKEEPER_ID": "",
+        "TASK_CODE": "", "ACTIVITY_CODE": "",
+        "EXPENSE_CODE": expense_cols["EXPENSE_CODE"], "DESCRIPTION": expense_cols["DESCRIPTION"],
+        "HOURS": expense_cols["HOURS"], "RATE": expense_cols["RATE"],
+        "LINE_ITEM_TOTAL": expense_cols["LINE_ITEM_TOTAL"],
+    })
+    frames = [frame for frame in (fees, expenses) if not frame.empty]
+    # With no fee templates left and no expenses requested there are no lines at all; the
+    # (empty) expense frame still carries every column, so it stands in for the invoice
+    df = pd.concat(frames, ignore_index=True) if frames else expenses
+
+    # Block Billing: make sure at least one block-billed line is present when they are requested
+    if include_block_billed and len(df) > 0 and not df["DESCRIPTION"].str.contains("; ", regex=False).any():
+        for _, _, desc in major_items + other_items:
+            if '; ' in desc:
+                extra = df.iloc[[0]].assign(DESCRIPTION=desc)
+                # The copied line is billed too, so the invoice total must include it
+                invoice_total_cents += int(round(extra["LINE_ITEM_TOTAL"].iloc[0] * 100))
+                df = pd.concat([extra, df])
+                break
+    return df.reset_index(drop=True), invoice_total_cents / 100
+
 
+# Pre-rendered 128x128 "NM" placeholder logo, so the fallback path never draws or encodes a PNG
+_DEFAULT_NM_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAIAAAACACAIAAABMXPacAAABuklEQVR42u3asa4hYRiA4f+wMdEgLkShRhAyQq9yJ1PI3Iub"
+    "mAa9RqtQqRVKCfm32EROzilW7MppnrcyH9X3TCbzJz5ijEE/V8kKAAAQAAACAEAAAAgAAAEAIAAABACAAAAQAAD6KYBqtToY"
+    "DB6XjUbjMZ/P54/5YrGoVqsW+v8BkiS53W7b7fb7/HA43O/3EEKM8Xg8JklioW95BOV5vlwuv8/b7fZutwsh7Pf7Vqtlm+8C"
+    "GA6HIYTNZvNlnqZpURQhhKIo0jS1zVeKf6ter8cYN5tNt9t9XP75cD6fO51OjHE8Hl8ul8dXer5n34L6/X65XF6v15+HzWaz"
+    "VCqdTqcQQq1Wcze/0K/nf5rneZZlX4aTySTLstFoZJVvPwf0er1KpXK9Xj8PZ7PZarWaTqdW+Vof/h3tJAxAAAAIAAABACAA"
+    "AAQAgAAAEAAAAgBAAAAIAAABACAAAAQAgAAAEAAAAgBAAAAIAAABACAAAAQAgAAAEAAAAgBAAAAIAAABACAAAAQAgAAAEAAA"
+    "AAQAgAAAEAAAAgBAAAAIAAABACAAAAQAgAAAEAAAAgBAAAAIAAABACAAAPRP/QYju6u/qTW6YwAAAABJRU5ErkJggg=="
+)
 
 # Helper function to get image bytes safely
+@st.cache_data(show_spinner=False)
 def _get_logo_image_bytes():
-    """Generates a default image or loads from file."""
-    from PIL import Image as PILImage, ImageDraw, ImageFont
-    
+    """Loads the logo from file as PNG bytes, falling back to a pre-rendered placeholder.
+
+    Cached so the decode and PNG re-encode run once per process instead of on every rerun.
+    """
     # Try to load a local image from the 'assets' folder
     try:
-        # Update the path to point to the '.jpg' file
-        image_path = "assets/nelsonmurdock2.jpg"
+        # Resolve against the script's directory so the app can be launched from anywhere
+        image_path = os.path.join(os.path.dirname(__file__), "assets", "nelsonmurdock2.jpg")
         img = PILImage.open(image_path)
         buf = io.BytesIO()
         # Save the image as PNG for compatibility with ReportLab
         img.save(buf, format="PNG")
-        buf.seek(0)
-        return buf
+        return buf.getvalue()
     except FileNotFoundError:
-        # Fallback to generating a simple image if the file is not found
-        st.warning("Image file (assets/icon.jpg) not found. A placeholder will be used.")
-        img = PILImage.new("RGB", (128, 128), color="white")
-        draw = ImageDraw.Draw(img)
-        try:
-            # Use a default font, as custom fonts might not be available
-            font = ImageFont.load_default()
-        except IOError:
-            font = ImageFont.load_default()
-        draw.text((10, 20), "NM", font=font, fill=(0, 0, 0))
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        buf.seek(0)
-        return buf
+        # Fall back to the pre-rendered placeholder if the file is not found
+        st.warning("Image file (assets/nelsonmurdock2.jpg) not found. A placeholder will be used.")
+        return _DEFAULT_NM_PNG
 
-def _create_pdf_invoice(df, total_amount, invoice_number, invoice_date, billing_start_date, billing_end_date, client_id, law_firm_id):
+@st.cache_resource
+def _get_pdf_assets():
     """
-    Generates a PDF invoice with a layout that matches the provided example.
-    Includes conditional address blocks and a clean header.
+    Paragraph and table styles shared by every PDF invoice. getSampleStyleSheet()
+    builds a few dozen styles, so they are made once per process and reused.
     """
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(
-        buffer,
-        pagesize=letter,
-        leftMargin=1.0 * inch, rightMargin=1.0 * inch,
-        topMargin=1.0 * inch, bottomMargin=1.0 * inch
-    )
     styles = getSampleStyleSheet()
-    available_width = doc.width
+    normal = styles["Normal"]
+    return {
+        "normal": normal,
+        "left": ParagraphStyle(name="Left", parent=normal, alignment=TA_LEFT, leading=12),
+        "client_info": ParagraphStyle(name="ClientInfoLeft", parent=normal, alignment=TA_LEFT),
+        "right": ParagraphStyle(name="Right", parent=normal, alignment=TA_RIGHT),
+        "logo_table": TableStyle([
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('LEFTPADDING', (1, 0), (1, 0), 6),
+        ]),
+        "header_table": TableStyle([
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('BOX', (0, 0), (0, 0), 1, colors.black),
+            ('BOX', (1, 0), (1, 0), 1, colors.black),
+            ('LEFTPADDING', (0, 0), (0, 0), 6),
+            ('RIGHTPADDING', (1, 0), (1, 0), 6),
+            ('ALIGN', (0, 0), (0, 0), 'LEFT'),
+            ('ALIGN', (1, 0), (1, 0), 'LEFT'),
+        ]),
+        "details_table": TableStyle([
+            ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('LEFTPADDING', (1, 0), (1, 0), 6),
+        ]),
+        "line_items_table": TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black),
+            ('BOX', (0, 0), (-1, -1), 1, colors.black),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, 0), 8),
+            ('FONTSIZE', (0, 1), (-1, -1), 7),
+            # Plain-string descriptions render in the same font size as Paragraph ones
+            ('FONTSIZE', (4, 1), (4, -1), normal.fontSize),
+            ('LEFTPADDING', (0, 0), (-1, -1), 2),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 2),
+            ('TOPPADDING', (0, 0), (-1, -1), 2),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
+            ('BACKGROUND', (0, 1), (-1, -1), colors.white),
+        ]),
+        "total_table": TableStyle([
+            ('LINEBELOW', (0, 0), (-1, -1), 1, colors.black),
+            ('ALIGN', (0, 0), (-1, -1), 'RIGHT'),
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+        ]),
+    }
+
+PDF_MARGIN = 1.0 * inch
+# Width of the frame inside the margins; the same for every invoice, so no doc is needed to get it
+PDF_AVAILABLE_WIDTH = letter[0] - 2 * PDF_MARGIN
+
+def _build_pdf_elements(df, total_amount, invoice_number, invoice_date, billing_start_date, billing_end_date, client_id, law_firm_id, assets):
+    """
+    Builds the flowables for one invoice: header, invoice details, line items and total.
+    Includes conditional address blocks and a clean header.
+    """
+    available_width = PDF_AVAILABLE_WIDTH
     elements = []
 
     # --- HEADER: Law Firm | Client (Boxed) ---
@@ -332,34 +494,25 @@ def _create_pdf_invoice(df, total_amount, invoice_number, invoice_date, billing_
             f"<b>Nelson and Murdock</b><br/>{law_firm_id}<br/>"
             "One Park Avenue<br/>Manhattan, NY 10003"
         )
-        logo_file_name = "nelsonmurdock2.jpg"
     else:
         law_firm_info = (
             f"<b>Your Law Firm Name</b><br/>{law_firm_id}<br/>"
             "1001 Main Street, Big City, CA 90000"
         )
-        logo_file_name = "icon.jpg" # Using a generic placeholder image
-
-    # Dynamically build the logo path from the script's directory
-    script_dir = os.path.dirname(__file__)
-    logo_path = os.path.join(script_dir, "assets", logo_file_name)
 
-    left_style = ParagraphStyle(name="Left", parent=styles["Normal"], alignment=TA_LEFT, leading=12)
-    law_firm_para = Paragraph(law_firm_info, left_style)
+    law_firm_para = Paragraph(law_firm_info, assets["left"])
     header_left_content = law_firm_para
 
     if law_firm_id == DEFAULT_LAW_FIRM_ID:
         try:
-            img = Image(logo_path, width=0.6 * inch, height=0.6 * inch)
+            # The logo bytes are cached, so no invoice re-reads or re-encodes the image file
+            img = Image(io.BytesIO(_get_logo_image_bytes()), width=0.6 * inch, height=0.6 * inch)
             inner_table_data = [[img, law_firm_para]]
             inner_table = Table(inner_table_data, colWidths=[0.7 * inch, None])
-            inner_table.setStyle(TableStyle([
-                ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-                ('LEFTPADDING', (1, 0), (1, 0), 6),
-            ]))
+            inner_table.setStyle(assets["logo_table"])
             header_left_content = inner_table
         except Exception as e:
-            logging.error(f"Error loading logo image from {logo_path}: {e}")
+            logging.error(f"Error loading logo image: {e}")
             st.warning("Could not load law firm logo. Using text instead.")
             header_left_content = law_firm_para
 
@@ -374,131 +527,351 @@ def _create_pdf_invoice(df, total_amount, invoice_number, invoice_date, billing_
             f"<b>Your Company Name</b><br/>{client_id}<br/>"
             "1000 Main Street, Big City, CA 90000"
         )
-    client_info_style = ParagraphStyle(name="ClientInfoLeft", parent=styles["Normal"], alignment=TA_LEFT)
-    client_para = Paragraph(client_info, client_info_style)
+    client_para = Paragraph(client_info, assets["client_info"])
 
     # Combined header table
     header_data = [
         [header_left_content, client_para]
     ]
     header_table = Table(header_data, colWidths=[available_width / 2, available_width / 2])
-    header_table.setStyle(TableStyle([
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('BOX', (0, 0), (0, 0), 1, colors.black),
-        ('BOX', (1, 0), (1, 0), 1, colors.black),
-        ('LEFTPADDING', (0, 0), (0, 0), 6),
-        ('RIGHTPADDING', (1, 0), (1, 0), 6),
-        ('ALIGN', (0, 0), (0, 0), 'LEFT'),
-        ('ALIGN', (1, 0), (1, 0), 'LEFT'),
-    ]))
+    header_table.setStyle(assets["header_table"])
     elements.append(header_table)
     elements.append(Spacer(1, 0.10 * inch))
 
     # -------- Invoice Details (right under Client Info) --------
-    right_style = ParagraphStyle(name="Right", parent=styles["Normal"], alignment=TA_RIGHT)
     invoice_details_text = (
         f"<b>Invoice #:</b> {invoice_number}<br/>"
         f"<b>Invoice Date:</b> {invoice_date.strftime('%Y-%m-%d')}<br/>"
         f"<b>Billing Period:</b> {billing_start_date.strftime('%Y-%m-%d')} to {billing_end_date.strftime('%Y-%m-%d')}"
     )
-    details_para = Paragraph(invoice_details_text, right_style)
+    details_para = Paragraph(invoice_details_text, assets["right"])
     details_table = Table(
         [['', details_para]],
         colWidths=[available_width / 2, available_width / 2]
     )
-    details_table.setStyle(TableStyle([
-        ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('LEFTPADDING', (1, 0), (1, 0), 6),
-    ]))
+    details_table.setStyle(assets["details_table"])
     elements.append(details_table)
     elements.append(Spacer(1, 0.18*inch))
 
     # --- INVOICE DETAILS TABLE ---
     # Table headers
     data = [['Date', 'Timekeeper', 'Task Code', 'Activity Code', 'Description', 'Hours', 'Rate', 'Total']]
-    
-    # Add line item rows
-    for _, row in df.iterrows():
-        # Correctly format rows to include Paragraphs for wrapping text
-        date = row['LINE_ITEM_DATE']
-        timekeeper = row['TIMEKEEPER_NAME'] if row['TIMEKEEPER_NAME'] else 'N/A'
-        task_code = row['TASK_CODE'] if row['TASK_CODE'] else 'N/A'
-        activity_code = row['ACTIVITY_CODE'] if row['ACTIVITY_CODE'] else 'N/A'
-        description = row['DESCRIPTION']
-        hours = row['HOURS']
-        rate = row['RATE']
-        total = row['LINE_ITEM_TOTAL']
-        
-        data.append([
-            date, 
-            timekeeper, 
-            task_code, 
-            activity_code, 
-            Paragraph(description, styles['Normal']),
-            f"{hours:.2f}", 
-            f"${rate:.2f}", 
-            f"${total:.2f}"
-        ])
+    col_widths = [1 * inch, 1.25 * inch, 0.75 * inch, 0.75 * inch, 2.25 * inch, 0.75 * inch, 0.75 * inch, 0.75 * inch]
+    desc_style = assets["normal"]
+    desc_width = col_widths[4] - 4  # minus the 2pt left/right cell padding
+
+    def desc_cell(description):
+        # Paragraph parsing is costly; only use it for markup or text that has to wrap
+        if _HAS_MARKUP(description) or stringWidth(description, desc_style.fontName, desc_style.fontSize) > desc_width:
+            return Paragraph(description, desc_style)
+        return description
+
+    # Add line item rows, formatting each column in one pass and then zipping them into rows
+    data.extend(map(list, zip(
+        df["LINE_ITEM_DATE"],
+        df["TIMEKEEPER_NAME"].replace("", "N/A"),
+        df["TASK_CODE"].replace("", "N/A"),
+        df["ACTIVITY_CODE"].replace("", "N/A"),
+        map(desc_cell, df["DESCRIPTION"]),
+        df["HOURS"].map(_fmt_2dp),
+        df["RATE"].map(_fmt_dollars),
+        df["LINE_ITEM_TOTAL"].map(_fmt_dollars),
+    )))
 
     # Table styling
-    table = Table(data, colWidths=[1 * inch, 1.25 * inch, 0.75 * inch, 0.75 * inch, 2.25 * inch, 0.75 * inch, 0.75 * inch, 0.75 * inch])
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ('BOX', (0, 0), (-1, -1), 1, colors.black),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 8),
-        ('FONTSIZE', (0, 1), (-1, -1), 7),
-        ('LEFTPADDING', (0, 0), (-1, -1), 2),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 2),
-        ('TOPPADDING', (0, 0), (-1, -1), 2),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.white),
-    ]))
+    table = Table(data, colWidths=col_widths)
+    table.setStyle(assets["line_items_table"])
     elements.append(table)
     elements.append(Spacer(1, 0.25 * inch))
 
     # --- TOTAL AMOUNT SECTION ---
     total_table_data = [[
-        Paragraph(f"<b>Total Amount Due:</b>", styles['Normal']),
-        Paragraph(f"<b>${total_amount:.2f}</b>", styles['Normal'])
+        Paragraph(f"<b>Total Amount Due:</b>", assets["normal"]),
+        Paragraph(f"<b>${total_amount:.2f}</b>", assets["normal"])
     ]]
     total_table = Table(total_table_data, colWidths=[4 * inch, None])
-    total_table.setStyle(TableStyle([
-        ('LINEBELOW', (0, 0), (-1, -1), 1, colors.black),
-        ('ALIGN', (0, 0), (-1, -1), 'RIGHT'),
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-    ]))
+    total_table.setStyle(assets["total_table"])
     elements.append(total_table)
 
-    doc.build(elements)
-    buffer.seek(0)
-    return buffer
+    return elements
 
-def _send_email_with_attachment(recipient_email, subject, body, attachments: list):
+def _create_pdf_invoice(df, total_amount, invoice_number, invoice_date, billing_start_date, billing_end_date, client_id, law_firm_id):
     """
-    Sends an email with multiple file attachments.
-    Gets credentials from Streamlit Secrets.
-    Attachments is a list of tuples: [(filename, data_bytes), ...].
+    Generates a PDF invoice with a layout that matches the provided example.
+    Returns the finished PDF as bytes.
     """
-    try:
-        sender_email = st.secrets.email.email_from
-        password = st.secrets.email.email_password
-    except AttributeError:
-        st.error("Email secrets not found. Please check your .streamlit/secrets.toml file.")
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(
+        buffer,
+        pagesize=letter,
+        leftMargin=PDF_MARGIN, rightMargin=PDF_MARGIN,
+        topMargin=PDF_MARGIN, bottomMargin=PDF_MARGIN
+    )
+    doc.build(_build_pdf_elements(
+        df, total_amount, invoice_number, invoice_date, billing_start_date, billing_end_date,
+        client_id, law_firm_id, _get_pdf_assets(),
+    ))
+    return buffer.getvalue()
+
+# Retry budget for transient SMTP failures: exponential backoff with jitter, capped
+SMTP_MAX_ATTEMPTS = 3
+SMTP_BACKOFF_BASE = 1.0
+SMTP_BACKOFF_CAP = 30.0
+# Connect + TLS + AUTH should be quick, so fail fast on dead hosts; DATA uploads get more room
+SMTP_CONNECT_TIMEOUT = 8.0
+SMTP_MIN_CONNECT_TIMEOUT = 5.0
+SMTP_COMMAND_TIMEOUT = 20.0
+# Once at least SMTP_BATCH_MIN_ATTEMPTS sends have been tried and more than this share of them
+# hit connection-level trouble, the rest of the batch is skipped
+SMTP_BATCH_MAX_FAILURE_RATIO = 1 / 3
+SMTP_BATCH_MIN_ATTEMPTS = 3
+# How often the page reruns to check on sends running in the background
+SEND_POLL_INTERVAL = 0.5
+
+@st.cache_resource
+def _get_ssl_context():
+    """
+    Loading the system CA bundle is costly and a client context is safe to share,
+    so one context is built per process (module-level code re-runs on every rerun).
+    """
+    return ssl.create_default_context()
+
+@st.cache_resource
+def _get_send_executor():
+    """
+    Sends run on a small shared pool so a slow SMTP server never blocks the script thread.
+    Each session occupies at most one worker at a time (see _queue_send_batch), so one
+    session's stalled server can't hold up everyone else's mail.
+    """
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="smtp-send")
+
+def _get_smtp_state():
+    """
+    Per-session SMTP state as a plain dict, so send threads (which cannot touch
+    st.session_state) can share it. Batches wait in "queue" and are drained by a single
+    pool task per session, which keeps two sends off one connection without a worker
+    ever blocking on another's lock; "lock" only guards the queue bookkeeping.
+    The shared SSL context and connection registry are fetched here, on the script thread,
+    for the send threads to use.
+    """
+    if "_smtp_state" not in st.session_state:
+        st.session_state["_smtp_state"] = {
+            "conn": None, "handshake_secs": None, "ssl_context": _get_ssl_context(),
+            "live_connections": _get_live_smtp_connections(),
+            "lock": threading.Lock(), "queue": deque(), "draining": False,
+        }
+    return st.session_state["_smtp_state"]
+
+@st.cache_resource
+def _get_live_smtp_connections():
+    """
+    Every open SMTP connection in the process, held weakly so closed or replaced ones
+    can be collected. A single atexit hook, registered here once, closes whatever is
+    still open at shutdown.
+    """
+    live = weakref.WeakSet()
+
+    def close_all():
+        for server in list(live):
+            _close_smtp(server)
+
+    atexit.register(close_all)
+    return live
+
+def _close_smtp(server):
+    """Politely closes an SMTP connection, ignoring errors from one that is already dead."""
+    if server is None:
         return
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
+def _load_smtp_config():
+    """
+    Collects the [email] section of Streamlit secrets into one dict. Read live on each
+    call, so edits to secrets.toml take effect on the next rerun.
+    Returns None when no sender credentials are configured.
+    """
+    try:
+        email_secrets = st.secrets["email"]
+    except (KeyError, FileNotFoundError):
+        return None
+    if not email_secrets.get("email_from") or not email_secrets.get("email_password"):
+        return None
+    return {
+        "server": email_secrets.get("smtp_server", "smtp.gmail.com"),
+        "port": int(email_secrets.get("smtp_port", 465)),
+        # Port 587 servers expect a plain connection upgraded with STARTTLS rather than implicit TLS
+        "use_tls": bool(email_secrets.get("smtp_use_tls", False)),
+        "from": email_secrets["email_from"],
+        "password": email_secrets["email_password"],
+    }
+
+def _open_smtp(host, port, use_tls, ctx, timeout):
+    """
+    Opens an SMTP connection secured with implicit TLS (SMTP_SSL), or with STARTTLS
+    when use_tls is set. The caller logs in on the returned connection.
+    """
+    if not use_tls:
+        return smtplib.SMTP_SSL(host, port, timeout=timeout, context=ctx)
+    server = smtplib.SMTP(host, port, timeout=timeout)
+    try:
+        # starttls() sends EHLO if needed, and login() re-sends it on the encrypted channel
+        server.starttls(context=ctx)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+def _get_smtp(smtp_config, smtp_state):
+    """
+    Returns a logged-in SMTP connection, reusing the one cached in this session.
+    The cached connection is probed with NOOP first; a fresh one is opened only if
+    it has gone away, which saves a TLS handshake and AUTH on every send.
+    """
+    key = (smtp_config["server"], smtp_config["port"], smtp_config["use_tls"], smtp_config["from"])
+    cached = smtp_state["conn"]
+    if cached is not None:
+        server, cached_key = cached
+        if cached_key == key:
+            try:
+                if server.noop()[0] == 250:
+                    return server
+            except (smtplib.SMTPException, OSError):
+                pass
+        _close_smtp(server)
+        smtp_state["conn"] = None
+
+    # Once a handshake has been timed, allow twice that (with a floor) rather than a fixed guess
+    last_handshake = smtp_state["handshake_secs"]
+    connect_timeout = SMTP_CONNECT_TIMEOUT if last_handshake is None else max(SMTP_MIN_CONNECT_TIMEOUT, 2 * last_handshake)
+    started = time.monotonic()
+    server = _open_smtp(key[0], key[1], key[2], smtp_state["ssl_context"], connect_timeout)
+    try:
+        server.login(smtp_config["from"], smtp_config["password"])
+    except Exception:
+        # Not cached or registered yet, so nothing else would ever close it
+        _close_smtp(server)
+        raise
+    smtp_state["handshake_secs"] = time.monotonic() - started
+    server.sock.settimeout(SMTP_COMMAND_TIMEOUT)
+    smtp_state["live_connections"].add(server)
+    smtp_state["conn"] = (server, key)
+    return server
+
+# Bad credentials or addresses fail the same way on every attempt, so they short-circuit retries
+_PERMANENT_SMTP_ERRORS = (
+    smtplib.SMTPAuthenticationError, smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+)
+# Connection-level failures that a fresh connection may well get past
+_TRANSIENT_SMTP_ERRORS = (
+    smtplib.SMTPServerDisconnected, socket.timeout, ConnectionRefusedError, ConnectionResetError,
+)
+
+def _is_retryable_smtp_error(exc):
+    """Transient failures (4xx replies, dropped or timed-out sockets) are worth retrying; the rest are not."""
+    if isinstance(exc, _PERMANENT_SMTP_ERRORS):
+        return False
+    if isinstance(exc, smtplib.SMTPResponseException):
+        # Also covers SMTPConnectError/SMTPHeloError: a 421 greeting is transient, a 554 is not
+        return 400 <= exc.smtp_code < 500
+    return isinstance(exc, _TRANSIENT_SMTP_ERRORS)
 
+def _is_server_level_smtp_error(exc):
+    """
+    True for failures that say the server or account is unusable (dropped or refused
+    connections, 4xx replies, a refused greeting, bad credentials), as opposed to a
+    5xx aimed at one message, such as 552 for an oversized attachment.
+    """
+    if isinstance(exc, (smtplib.SMTPConnectError, smtplib.SMTPAuthenticationError)):
+        return True
+    return _is_retryable_smtp_error(exc) or (isinstance(exc, OSError) and not isinstance(exc, smtplib.SMTPException))
+
+def _send_batch(jobs, smtp_config, smtp_state):
+    """
+    Sends one generate run's emails in order over the session's connection. jobs is a list
+    of (recipients, payload); returns a matching list of (recipients, error or None).
+    A failed message doesn't stop the others, but once enough sends have hit server-level
+    trouble the rest are skipped instead of each waiting out its own retries.
+    Runs on a send thread, so it must not call any st.* function.
+    """
+    results = []
+    attempted = failed = 0
+    for recipients, payload in jobs:
+        if attempted >= SMTP_BATCH_MIN_ATTEMPTS and failed > attempted * SMTP_BATCH_MAX_FAILURE_RATIO:
+            results.append((recipients, RuntimeError(f"skipped after {failed} of {attempted} sends in this batch failed")))
+            continue
+        attempted += 1
+        try:
+            _send_with_retry(payload, recipients, smtp_config, smtp_state)
+            results.append((recipients, None))
+        except Exception as e:
+            if _is_server_level_smtp_error(e):
+                failed += 1
+            results.append((recipients, e))
+    return results
+
+def _drain_send_queue(smtp_state):
+    """Pool task that sends a session's queued batches one after another, then exits."""
+    while True:
+        with smtp_state["lock"]:
+            if not smtp_state["queue"]:
+                smtp_state["draining"] = False
+                return
+            jobs, smtp_config, future = smtp_state["queue"].popleft()
+        if not future.set_running_or_notify_cancel():
+            continue
+        try:
+            future.set_result(_send_batch(jobs, smtp_config, smtp_state))
+        except Exception as e:
+            future.set_exception(e)
+
+def _queue_send_batch(jobs, smtp_config):
+    """
+    Queues a batch for this session and makes sure one pool task is draining the queue.
+    Returns a Future for the batch's list of (recipients, error or None).
+    """
+    smtp_state = _get_smtp_state()
+    future = Future()
+    with smtp_state["lock"]:
+        smtp_state["queue"].append((jobs, smtp_config, future))
+        start_drain = not smtp_state["draining"]
+        smtp_state["draining"] = True
+    if start_drain:
+        _get_send_executor().submit(_drain_send_queue, smtp_state)
+    return future
+
+def _send_with_retry(payload, recipients, smtp_config, smtp_state):
+    """
+    Sends an already-serialized message over the session's SMTP connection, retrying
+    transient failures with backoff. Only called from the session's drain task.
+    """
+    for attempt in range(SMTP_MAX_ATTEMPTS):
+        try:
+            _get_smtp(smtp_config, smtp_state).sendmail(smtp_config["from"], recipients, payload)
+            return
+        except Exception as e:
+            # Don't hand a broken connection to the next attempt; after a rejection aimed at
+            # this message alone (refused recipient, 552) sendmail has already sent RSET, so
+            # the connection stays usable for the next invoice
+            if _is_server_level_smtp_error(e):
+                _close_smtp((smtp_state["conn"] or (None, None))[0])
+                smtp_state["conn"] = None
+            if attempt == SMTP_MAX_ATTEMPTS - 1 or not _is_retryable_smtp_error(e):
+                raise
+            delay = min(SMTP_BACKOFF_CAP, SMTP_BACKOFF_BASE * 2 ** attempt)
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+def _build_message(sender_email, recipients, subject, body, attachments):
+    """Builds the MIME message and serializes it once, for every send attempt to reuse."""
     msg = MIMEMultipart()
     
     # Set the 'From' header with both the desired name and the sender's email address
     from_name = "Onit Invoice Generation"
     msg['From'] = f'"{from_name}" <{sender_email}>'
     
-    msg['To'] = recipient_email
+    msg['To'] = ", ".join(recipients)
     msg['Subject'] = subject
 
     msg.attach(MIMEText(body, 'plain'))
@@ -508,13 +881,82 @@ def _send_email_with_attachment(recipient_email, subject, body, attachments: lis
         part['Content-Disposition'] = f'attachment; filename="{filename}"'
         msg.attach(part)
     
-    try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-            server.login(sender_email, password)
-            server.send_message(msg)
-        st.success(f"Email sent successfully to {recipient_email}!")
-    except Exception as e:
-        st.error(f"Error sending email: {e}")
+    # Serialize once with CRLF line endings, rather than on every send_message() attempt
+    return msg.as_bytes(policy=email_policy.SMTP)
+
+def _prepare_email_with_attachment(smtp_config, recipient_email, subject, body, attachments: list):
+    """
+    Builds an email with multiple file attachments, ready for _queue_send_batch.
+    Attachments is a list of tuples: [(filename, data_bytes), ...].
+    The message is built here, on the script thread; only the SMTP exchange runs in the
+    background. Returns the job as (recipients, payload).
+    """
+    # Several billing contacts share one message: a single SMTP transaction with one RCPT TO each
+    recipients = tuple(addr.strip() for addr in recipient_email.split(",") if addr.strip())
+    return recipients, _build_message(smtp_config["from"], recipients, subject, body, attachments)
+
+def _render_generated_outputs():
+    """
+    Shows the previews and download buttons from the last generate run. They are read
+    back from session state, so they stay on the page across reruns until the next run.
+    """
+    generated_invoices = st.session_state.get("_generated_outputs")
+    if generated_invoices is None:
+        return
+    for i, (ledes_content, ledes_filename, pdf_attachment) in enumerate(generated_invoices):
+        st.subheader(f"Generated Invoice {i + 1}")
+
+        # Use a text area for display
+        st.text_area("LEDES 1998B Content", ledes_content.decode('utf-8'), height=200)
+
+        # Download buttons
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button(
+                label="Download LEDES File",
+                data=ledes_content,
+                file_name=ledes_filename,
+                mime="text/plain",
+                key=f"download_ledes_{i}"
+            )
+        with col2:
+            if pdf_attachment is not None:
+                pdf_filename, pdf_bytes = pdf_attachment
+                st.download_button(
+                    label="Download PDF Invoice",
+                    data=pdf_bytes,
+                    file_name=pdf_filename,
+                    mime="application/pdf",
+                    key=f"download_pdf_{i}"
+                )
+    st.success("Invoice generation complete!")
+
+def _render_send_status():
+    """
+    Reports on background send batches queued in this session. While any are still in
+    flight the page reruns every SEND_POLL_INTERVAL seconds, leaving widgets usable.
+    """
+    pending_sends = st.session_state.get("_send_futures")
+    if not pending_sends:
+        return
+    for _, future in pending_sends:
+        if not future.done():
+            continue
+        if future.exception() is not None:
+            st.error(f"Error sending email: {future.exception()}")
+            continue
+        for recipients, error in future.result():
+            if error is None:
+                st.success(f"Email sent successfully to {', '.join(recipients)}!")
+            else:
+                st.error(f"Error sending email: {error}")
+    in_flight = sum(count for count, future in pending_sends if not future.done())
+    if in_flight:
+        st.info(f"Sending {in_flight} email(s) in the background...")
+        time.sleep(SEND_POLL_INTERVAL)
+        st.rerun()
+    else:
+        del st.session_state["_send_futures"]
 
 # --- Streamlit App UI ---
 st.title("LEDES Invoice Generator")
@@ -596,8 +1038,9 @@ with tab2:
 if send_email:
     with tab3:
         st.header("Email Delivery")
-        recipient_email = st.text_input("Recipient Email Address:")
-        st.caption(f"Sender Email will be from: {st.secrets.get('email', {}).get('username', 'N/A')}")
+        recipient_email = st.text_input("Recipient Email Address:", help="Separate multiple addresses with commas.")
+        smtp_config = _load_smtp_config()
+        st.caption(f"Sender Email will be from: {smtp_config['from'] if smtp_config else 'N/A'}")
 else:
     # If not sending email, still need to define these variables
     recipient_email = None
@@ -620,6 +1063,12 @@ if generate_button:
             st.warning(f"You have selected to generate {num_invoices} invoices, but have provided {len(descriptions)} descriptions. Please provide one description per period.")
         else:
             progress_bar = st.progress(0)
+            send_jobs = []
+            generated_invoices = []
+            smtp_config = _load_smtp_config() if send_email else None
+            if send_email and smtp_config is None:
+                st.error("Email secrets not found. Please check your .streamlit/secrets.toml file.")
+            major_items, other_items = _split_task_activity_items(task_activity_desc, MAJOR_TASK_CODES, include_block_billed)
             
             # Loop for multiple invoices
             for i in range(num_invoices):
@@ -629,69 +1078,46 @@ if generate_button:
                 current_invoice_desc = descriptions[i] if multiple_periods and i < len(descriptions) else descriptions[0]
                 
                 # Generate invoice data
-                rows, total_amount = _generate_invoice_data(
+                df_invoice, total_amount = _generate_invoice_data(
                     fees, expenses, timekeeper_data, client_id, law_firm_id,
                     current_invoice_desc, billing_start_date, billing_end_date,
-                    task_activity_desc, MAJOR_TASK_CODES, max_daily_hours, include_block_billed, faker
+                    major_items, other_items, max_daily_hours, include_block_billed
                 )
-                df_invoice = pd.DataFrame(rows)
                 
                 # Filenames
                 current_invoice_number = f"{invoice_number_base}-{i+1}"
                 current_matter_number = matter_number_base
                 
                 # Create LEDES 1998B content
-                ledes_content = _create_ledes_1998b_content(rows, total_amount, billing_start_date, billing_end_date, current_invoice_number, current_matter_number)
+                ledes_content = _create_ledes_1998b_content(df_invoice, total_amount, billing_start_date, billing_end_date, current_invoice_number, current_matter_number)
                 
                 # Prepare attachments
                 attachments_to_send = []
                 
                 # Add LEDES file
                 ledes_filename = f"LEDES_1998B_{current_invoice_number}.txt"
-                attachments_to_send.append((ledes_filename, ledes_content.encode('utf-8')))
+                attachments_to_send.append((ledes_filename, ledes_content))
 
                 # Add PDF file if requested
                 if include_pdf:
-                    pdf_buffer = _create_pdf_invoice(df_invoice, total_amount, current_invoice_number, billing_end_date, billing_start_date, billing_end_date, client_id, law_firm_id)
+                    pdf_bytes = _create_pdf_invoice(df_invoice, total_amount, current_invoice_number, billing_end_date, billing_start_date, billing_end_date, client_id, law_firm_id)
                     pdf_filename = f"Invoice_{current_invoice_number}.pdf"
-                    attachments_to_send.append((pdf_filename, pdf_buffer.getvalue()))
-                    pdf_buffer.seek(0)
+                    attachments_to_send.append((pdf_filename, pdf_bytes))
 
                 # Handle output
                 if send_email:
-                    _send_email_with_attachment(
-                        recipient_email,
-                        f"LEDES Invoice for {current_matter_number}",
-                        f"Please find the attached invoice files for matter {current_matter_number}.",
-                        attachments_to_send
-                    )
+                    if smtp_config is not None:
+                        send_jobs.append(_prepare_email_with_attachment(
+                            smtp_config,
+                            recipient_email,
+                            f"LEDES Invoice for {current_matter_number}",
+                            f"Please find the attached invoice files for matter {current_matter_number}.",
+                            attachments_to_send
+                        ))
                     
                 else:
-                    st.subheader(f"Generated Invoice {i + 1}")
-                    
-                    # Use a text area for display
-                    st.text_area("LEDES 1998B Content", ledes_content, height=200)
-
-                    # Download buttons
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        st.download_button(
-                            label="Download LEDES File",
-                            data=ledes_content.encode('utf-8'),
-                            file_name=ledes_filename,
-                            mime="text/plain",
-                            key=f"download_ledes_{i}"
-                        )
-                    with col2:
-                        if include_pdf:
-                            pdf_buffer = _create_pdf_invoice(df_invoice, total_amount, current_invoice_number, billing_end_date, billing_start_date, billing_end_date, client_id, law_firm_id)
-                            st.download_button(
-                                label="Download PDF Invoice",
-                                data=pdf_buffer.getvalue(),
-                                file_name=pdf_filename,
-                                mime="application/pdf",
-                                key=f"download_pdf_{i}"
-                            )
+                    # Shown by _render_generated_outputs; reuses the bytes built for the attachment list
+                    generated_invoices.append((ledes_content, ledes_filename, attachments_to_send[1] if include_pdf else None))
                         
                 if multiple_periods:
                     end_of_current_period = billing_start_date - datetime.timedelta(days=1)
@@ -699,4 +1125,12 @@ if generate_button:
                     billing_start_date = start_of_current_period
                     billing_end_date = end_of_current_period
             
-            st.success("Invoice generation complete!")
\ No newline at end of file
+            # Kept in session state so the results survive later reruns (e.g. send-status polling)
+            st.session_state["_generated_outputs"] = generated_invoices
+            if send_jobs:
+                # The whole run goes out as one batch, sent in order on the session's connection
+                queued = (len(send_jobs), _queue_send_batch(send_jobs, smtp_config))
+                st.session_state["_send_futures"] = st.session_state.get("_send_futures", []) + [queued]
+
+_render_generated_outputs()
+_render_send_status()
\ No newline at end of file